@@ -19,8 +19,16 @@ POLLY_MERGE_TRIGGER_COMMENT - modify the comment used to trigger merge,
 POLLY_MERGE_LOG_FILE - file to output logs to, e.g. /tmp/polly-merge.log
   outputs to stdout if log file is not specified
 
+the usual http_proxy/https_proxy/no_proxy environment variables are honored
+(proxy authentication isn't supported). redirects aren't followed, so
+POLLY_MERGE_BITBUCKET_URL needs to be the server's final url, eg https://
+rather than an http:// url that redirects there.
+
 polly-merge could be run via a cron job to have it operate asynchronously to
-user action.
+user action. between runs it keeps a small cache in
+$XDG_CACHE_HOME/polly-merge (default ~/.cache/polly-merge); it's safe to delete.
+a command added by editing an existing comment can take up to an hour to be
+noticed, since editing doesn't mark the pr as updated.
 
 it outputs progress information to stderr, and the following information to
 stdout:
@@ -31,16 +39,21 @@ eg for setting up fsnotify or something on the file where output is redirected.
 polly-merge is a broke person's bors-ng 😔
 """
 
+import functools
+import hashlib
+import http.client
+import itertools
 import json
 import logging
 import os
 import re
+import select
 import sys
-import urllib.error
+import threading
+import time
 import urllib.parse
 import urllib.request
-from distutils import util as distutils_util
-from multiprocessing.dummy import Pool
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 try:
     import coloredlogs
@@ -74,100 +87,425 @@ except ImportError:
             """nothing"""
 
 
-def http_operation(url, verb, headers=None, params=""):
+try:
+    # orjson is a good bit faster at decoding the (sometimes large) activities
+    # pages, but the stdlib decoder works fine too
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+
+def strtobool(value):
+    """
+    Convert a string representation of truth to True or False, same as the
+    (deprecated, removed in python 3.12) distutils.util.strtobool
+    """
+    value = value.strip().lower()
+    if value in ("y", "yes", "t", "true", "on", "1"):
+        return True
+    if value in ("n", "no", "f", "false", "off", "0"):
+        return False
+    raise ValueError(f"invalid truth value {value!r}")
+
+
+# idle keep-alive connections, keyed by (scheme, netloc). http.client
+# connections aren't thread safe, so each one is checked out for a single
+# request and put back once the response is read. that lets every thread, and
+# every thread pool, reuse the same TCP+TLS sessions instead of doing a fresh
+# handshake for every request
+_IDLE_CONNECTIONS = {}
+_IDLE_CONNECTIONS_LOCK = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_proxy(scheme, netloc):
+    """
+    Return (host, port) of the proxy to use for scheme://netloc, from the usual
+    http_proxy/https_proxy/no_proxy environment variables, or None for a direct
+    connection
+    """
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(netloc):
+        return None
+    if "://" not in proxy:
+        proxy = f"http://{proxy}"
+    split_proxy = urllib.parse.urlsplit(proxy)
+    return (split_proxy.hostname, split_proxy.port or 80)
+
+
+def connection_dropped(connection):
+    """
+    Return True if an idle connection's socket was closed by the server. an
+    idle keep-alive socket has nothing to read, so if it's readable, that's
+    the server hanging up (or sending something we can't use anyway)
+    """
+    if connection.sock is None:
+        # not connected; it'll just open a new socket
+        return False
+    readable, _, _ = select.select([connection.sock], [], [], 0)
+    return bool(readable)
+
+
+def get_connection(scheme, netloc):
+    """Check out an idle connection to scheme://netloc, or open a new one"""
+    while True:
+        with _IDLE_CONNECTIONS_LOCK:
+            idle = _IDLE_CONNECTIONS.get((scheme, netloc))
+            if not idle:
+                break
+            connection = idle.pop()
+        # don't hand out connections the server has already closed
+        if not connection_dropped(connection):
+            return connection
+        connection.close()
+
+    proxy = get_proxy(scheme, netloc)
+    if scheme == "https":
+        if proxy:
+            # tunnel through the proxy with CONNECT; TLS is still end to end
+            connection = http.client.HTTPSConnection(*proxy, timeout=10)
+            connection.set_tunnel(netloc)
+            return connection
+        return http.client.HTTPSConnection(netloc, timeout=10)
+    if proxy:
+        return http.client.HTTPConnection(*proxy, timeout=10)
+    return http.client.HTTPConnection(netloc, timeout=10)
+
+
+def release_connection(scheme, netloc, connection):
+    """Return a connection from get_connection to the idle pool"""
+    with _IDLE_CONNECTIONS_LOCK:
+        _IDLE_CONNECTIONS.setdefault((scheme, netloc), []).append(connection)
+
+
+# rate limited, or the server is briefly unavailable; worth retrying after a
+# short wait (the Retry-After header if there is one, otherwise exponential
+# backoff starting at RETRY_BACKOFF seconds)
+RETRY_STATUSES = (429, 502, 503, 504)
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.5
+RETRY_AFTER_MAX = 30
+
+# upper bound on simultaneous requests; enough to keep plenty of requests in
+# flight without hammering the server (or tripping its rate limiting)
+MAX_THREADS = 32
+
+
+def should_retry(verb, response):
+    """
+    Return True if the request is worth retrying. a gateway error (502/504)
+    doesn't mean the server didn't act on the request, so only GETs are retried
+    on those; a POST (eg a merge) that may already have gone through is only
+    retried when the server says it was turned away (429, or 503 with a
+    Retry-After)
+    """
+    if verb == "GET":
+        return response.status in RETRY_STATUSES
+    return response.status == 429 or (
+        response.status == 503 and "Retry-After" in response.headers
+    )
+
+
+def send_request(scheme, netloc, verb, target, headers):
+    """
+    Send a single request on a pooled connection. return tuple of:
+    ( <http.client.HTTPResponse>, <response data> )
+    """
+    connection = get_connection(scheme, netloc)
+
+    # plain http proxies take the full url instead of just the path
+    if scheme == "http" and get_proxy(scheme, netloc):
+        target = f"http://{netloc}{target}"
+
+    # if the socket was already open, the server may have dropped it while it
+    # was idle, so reconnect and try once more. only for GETs though; the
+    # error can come after the request was sent, and eg a merge POST may
+    # already have gone through
+    reused = connection.sock is not None
+    try:
+        try:
+            connection.request(verb, target, headers=headers)
+            response = connection.getresponse()
+        except ConnectionError:
+            if not reused or verb != "GET":
+                raise
+            connection.close()
+            connection.request(verb, target, headers=headers)
+            response = connection.getresponse()
+        the_page = response.read()
+    except (http.client.HTTPException, OSError):
+        # don't put a connection in an unknown state back in the pool
+        connection.close()
+        raise
+
+    release_connection(scheme, netloc, connection)
+    return (response, the_page)
+
+
+def http_operation(url, verb, headers=None, params="", log_errors=True):
     """
     execute the HTTP verb. return tuple of:
     ( <bool success?>, <response data>, <response headers> )
+
+    a "304 Not Modified" response (to a conditional request) is a success with
+    None for the response data. on an error response the data is the error body,
+    and a warning is logged unless log_errors is False (for callers that report
+    the error themselves)
     """
 
-    # encode the url-params
-    if params:
+    # encode the url-params, unless they're already an encoded query string
+    if params and not isinstance(params, str):
         params = urllib.parse.urlencode(params)
 
-    # always request JSON
-    total_headers = {"Content-Type": "application/json"}
-    if headers:
-        total_headers.update(headers)
+    # only POSTs have a (JSON) body; for everything else headers are used as-is,
+    # so callers can build them once and reuse them for every request
+    if verb == "POST":
+        headers = {**(headers or {}), "Content-Type": "application/json"}
+
+    split_url = urllib.parse.urlsplit(url)
+    target = f"{split_url.path}?{params}" if params else split_url.path
+
+    backoff = RETRY_BACKOFF
+    for attempt in range(RETRY_ATTEMPTS + 1):
+        response, the_page = send_request(
+            split_url.scheme, split_url.netloc, verb, target, headers or {}
+        )
+        if attempt == RETRY_ATTEMPTS or not should_retry(verb, response):
+            break
+
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            time.sleep(min(int(retry_after), RETRY_AFTER_MAX))
+        else:
+            time.sleep(backoff)
+            backoff *= 2
+
+    if response.status == http.client.NOT_MODIFIED:
+        return (True, None, response.headers)
+
+    if not 200 <= response.status < 300:
+        if log_errors:
+            logging.warning(
+                f"{verb} {url}: HTTP Error {response.status}: {response.reason}"
+            )
+        return (False, the_page, response.headers)
+
+    return (True, the_page, response.headers)
 
-    # TODO we should be able to pass params as second field but doesn't work :(
-    url = f"{url}?{params}"
-    req = urllib.request.Request(url, None, total_headers, method=verb)
 
+def cache_path(filename):
+    """
+    Return the path to filename in the polly-merge cache directory (creating
+    the directory if needed). Honors XDG_CACHE_HOME, default ~/.cache
+    """
+    cache_dir = os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "polly-merge",
+    )
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(cache_dir, filename)
+
+
+def read_cache(filename):
+    """Return the json data cached in filename, or None if there isn't any"""
+    try:
+        with open(cache_path(filename), "rb") as cache_file:
+            return json_loads(cache_file.read())
+    except (OSError, ValueError):
+        return None
+
+
+def write_cache(filename, data):
+    """Save json data to filename in the cache. Failures are ignored"""
     try:
-        with urllib.request.urlopen(req, timeout=10) as response:
-            the_page = response.read()
-    except urllib.error.HTTPError as exception:
-        print(url)
-        print(exception)
-        return (False, None, None)
+        with open(cache_path(filename), "w", encoding="utf-8") as cache_file:
+            json.dump(data, cache_file)
+    except OSError:
+        pass
 
-    # TODO pass response code? + headers
-    return (True, the_page, None)
 
+# short lived cache of successful GET responses, keyed by url + params. several
+# prs often "merge-after" the same upstream pr, so this avoids re-fetching it.
+# each key has its own lock, so when those prs are processed at the same time
+# only the first one fetches, and the rest wait for its response
+_RESPONSE_CACHE = {}
+_RESPONSE_CACHE_KEY_LOCKS = {}
+_RESPONSE_CACHE_LOCK = threading.Lock()
+_RESPONSE_CACHE_TTL = 30
 
-def post_url(url, headers=None, params=""):
-    """Simple POST"""
-    return http_operation(url, "POST", headers, params)
 
+def cached_get_url(url, headers=None, params=""):
+    """GET, but reuse a successful response fetched in the last few seconds"""
+    key = (url, tuple(sorted((params or {}).items())))
+    with _RESPONSE_CACHE_LOCK:
+        key_lock = _RESPONSE_CACHE_KEY_LOCKS.setdefault(key, threading.Lock())
 
-def get_url(url, headers=None, params=""):
-    """Simple GET"""
-    return http_operation(url, "GET", headers, params)
+    with key_lock:
+        cached = _RESPONSE_CACHE.get(key)
+        if cached and time.monotonic() - cached[0] < _RESPONSE_CACHE_TTL:
+            return cached[1]
 
+        result = http_operation(url, "GET", headers=headers, params=params)
+        if result[0]:
+            _RESPONSE_CACHE[key] = (time.monotonic(), result)
+    return result
 
-def get_paged_api(full_url, headers, params=None):
+
+def iter_paged_api(full_url, headers, params=None, start=0):
     """
-    read a "paged api", return the values field
+    read a "paged api", yielding each item of the values field. pages are
+    fetched as they're consumed, so stopping early skips the remaining pages
     https://docs.atlassian.com/bitbucket-server/rest/5.16.0/bitbucket-rest.html#paging-params
     """
-    if not params:
-        params = {}
-    page_data = {"isLastPage": False, "values": []}
-    start = 0
-    while not page_data["isLastPage"]:
-        params.update({"start": start})
-
-        single_page_ok, single_page_data, _ = get_url(
-            full_url, headers=headers, params=params
+    # the params are the same for every page; encode them once, and just tack
+    # on the page start for each request
+    query = urllib.parse.urlencode(params or {})
+    query = f"{query}&start=" if query else "start="
+
+    while True:
+        single_page_ok, single_page_data, _ = http_operation(
+            full_url, "GET", headers=headers, params=f"{query}{start}"
         )
         assert single_page_ok, "error fetching list"
 
-        single_page_data = json.loads(single_page_data)
+        single_page_data = json_loads(single_page_data)
 
-        # add this page of data
-        page_data["values"].extend(single_page_data["values"])
-        page_data["isLastPage"] = single_page_data.get(
-            "isLastPage", page_data["isLastPage"]
-        )
+        # emit this page of data
+        yield from single_page_data["values"]
 
-        # move to the next page
-        if "nextPageStart" in single_page_data:
-            start = single_page_data["nextPageStart"]
-        else:
+        # move to the next page. nextPageStart is only present when isLastPage
+        # is false, but stop if either says this is the end
+        start = single_page_data.get("nextPageStart")
+        if single_page_data.get("isLastPage", True) or start is None:
             break
 
-    return page_data["values"]
+
+# largest page size bitbucket server allows by default. the paged apis don't
+# report a total, so pages can only be fetched one after another; asking for
+# big pages keeps most lists to a single request
+PAGE_LIMIT = 1000
+
+# editing a comment doesn't change a pr's updatedDate or comment count, so a
+# reused comment scan result is only trusted for this long (seconds) before the
+# comments are scanned again
+COMMENT_CACHE_MAX_AGE = 60 * 60
+
+
+@functools.lru_cache(maxsize=4)
+def compile_command_regex(merge_trigger):
+    """
+    Return a single compiled regex matching a line with any command for
+    merge_trigger (use with fullmatch); the "command" group holds the command
+    name plus argument, eg "merge" or "merge-after <url>". Cached, so the
+    pattern is only compiled once per run instead of once per pr.
+    """
+    # commands: merge, merge-after <url>
+    return re.compile(
+        f"{re.escape(merge_trigger)}" r"\s+(?P<command>merge-after\s+\S+|merge)"
+    )
 
 
 class BitbucketApi:
     """Used to interact with the bitbucket api"""
 
     def __init__(self, base_url, auth_header):
-        self.base_url = base_url
         self.auth_header = auth_header
+        # headers for every request; always request JSON
+        self.headers = {
+            **auth_header,
+            "Accept": "application/json",
+            "User-Agent": "polly-merge",
+        }
+        self.api_root = base_url.rstrip("/") + "/rest/api/1.0"
+        # pr url stems known to be merged or still open, see prefetch_merged()
+        self.merged_prs = set()
+        self.open_prs = set()
+        # comment scan results, see find_comment_command(). the previous run's
+        # are loaded by load_comment_cache()
+        self.comment_cache = {}
+        self.new_comment_cache = {}
+
+    def cache_filename(self, name):
+        """Return a cache filename for name, separate per server + user"""
+        cache_key = hashlib.sha256(
+            f"{self.api_root} {self.auth_header}".encode()
+        ).hexdigest()[:16]
+        return f"{name}-{cache_key}.json"
+
+    def load_comment_cache(self):
+        """Load the comment scan results saved by the last run"""
+        self.comment_cache = read_cache(self.cache_filename("comments")) or {}
+
+    def save_comment_cache(self):
+        """
+        Save this run's comment scan results. prs that weren't scanned this run
+        (eg merged or closed since) are dropped
+        """
+        write_cache(self.cache_filename("comments"), self.new_comment_cache)
+
+    def pr_api_url(self, projectkey, repositoryslug, pullrequestid):
+        """Return the api url for a pr; the stem for all the per-pr apis"""
+        return f"{self.api_root}/projects/{projectkey}/repos/{repositoryslug}/pull-requests/{pullrequestid}"
 
     def get_open_prs(self):
-        """Return list of open prs"""
-        return get_paged_api(
-            f"{self.base_url}/rest/api/1.0/dashboard/pull-requests",
-            headers=self.auth_header,
-            params={"state": "open", "role": "author"},
+        """
+        Return list of open prs.
+
+        When run on a cron the list is usually the same as last time, so the
+        last (single page) result is saved along with its ETag and/or
+        Last-Modified, and the server is asked to only send the list again if
+        it's changed.
+        """
+        dashboard_url = f"{self.api_root}/dashboard/pull-requests"
+        params = {"state": "open", "role": "author", "limit": PAGE_LIMIT}
+
+        cache_file = self.cache_filename("dashboard")
+        cached = read_cache(cache_file)
+
+        headers = dict(self.headers)
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        result, response_json, response_headers = http_operation(
+            dashboard_url, "GET", headers=headers, params={**params, "start": 0}
         )
+        assert result, "error fetching list"
+
+        # not modified since last time
+        if response_json is None:
+            return cached["values"]
+
+        response = json_loads(response_json)
+        if not response.get("isLastPage", True):
+            # more than one page; the validators only cover the first one, so just
+            # fetch the rest and don't cache it
+            rest = iter_paged_api(
+                dashboard_url,
+                headers=self.headers,
+                params=params,
+                start=response["nextPageStart"],
+            )
+            return response["values"] + list(rest)
+
+        etag = response_headers.get("ETag")
+        last_modified = response_headers.get("Last-Modified")
+        if etag or last_modified:
+            write_cache(
+                cache_file,
+                {
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "values": response["values"],
+                },
+            )
+        return response["values"]
 
     @staticmethod
-    def recurse_comments(comments, comments_text, username_filter):
+    def walk_comments(comments, username_filter):
         """
-        recurse nested comments. the activities api returns stuff like:
+        walk nested comments. the activities api returns stuff like:
 
         "comment": {
             "id": 1158611,
@@ -179,23 +517,28 @@ class BitbucketApi:
                 "id": 1158922,
                 "text": "some text"
 
-        etc. so recurse through it
+        etc. so walk through it, yielding each comment's text in thread order.
+        uses an explicit stack instead of recursion, so deep reply chains can't
+        hit the recursion limit.
 
         If username_filter is not None, only comments written by that user will
         be returned.
         """
-        for comment in comments:
+        # this runs once per comment, so bind the stack methods to locals
+        stack = list(reversed(comments))
+        pop, extend = stack.pop, stack.extend
+        while stack:
+            comment = pop()
             if username_filter is None or comment["author"]["name"] == username_filter:
-                comments_text.append(comment["text"])
-            BitbucketApi.recurse_comments(
-                comment["comments"], comments_text, username_filter
-            )
+                yield comment["text"]
+            extend(reversed(comment["comments"]))
 
-    def get_all_comments(
-        self, projectkey, repositoryslug, pullrequestid, username_filter
-    ):
+    def get_all_comments(self, pr_api_url, username_filter):
         """
-        get comments for a pr
+        generate comments for a pr (pr_api_url from pr_api_url()), fetching
+        pages of activities only as they're consumed, so a caller that stops
+        early (eg on the first comment with a command) skips the remaining
+        pages.
         If username_filter is not None, only comments written by that user will
         be returned.
         """
@@ -204,29 +547,20 @@ class BitbucketApi:
         # the diff) for comments, so you can't see general comments. Use the
         # activities api instead, and parse it for comments
         # /REST/API/1.0/projects/{projectkey}/repos/{repositoryslug}/pull-requests/{pullrequestid}/activities
-        activities = get_paged_api(
-            f"{self.base_url}/rest/api/1.0/projects/{projectkey}/repos/{repositoryslug}/pull-requests/{pullrequestid}/activities",
-            headers=self.auth_header,
+        # the default page size is only 25 activities; ask for the server max so
+        # busy prs are usually still a single request
+        activities = iter_paged_api(
+            f"{pr_api_url}/activities",
+            headers=self.headers,
+            params={"limit": PAGE_LIMIT},
         )
 
-        comments_text = []
+        walk_comments = self.walk_comments
         for activity in activities:
             if activity["action"] == "COMMENTED":
-                comment = activity["comment"]
-
-                # for now, just add the raw text from each comment
-                if (
-                    username_filter is None
-                    or comment["author"]["name"] == username_filter
-                ):
-                    comments_text.append(comment["text"])
-
-                # recurse through nested comments
-                self.recurse_comments(
-                    comment["comments"], comments_text, username_filter
-                )
-
-        return comments_text
+                # for now, just yield the raw text from each comment and its
+                # replies
+                yield from walk_comments((activity["comment"],), username_filter)
 
     def is_pr_merged(self, pr_url_stem):
         """
@@ -234,128 +568,281 @@ class BitbucketApi:
         Returns True if the specified PR is merged False otherwise
         "pr_url_stem" should look like "/projects/<project name>/repos/<repo slug>/pull-requests/<pr id>"
         """
-        result, response_json, _ = get_url(
-            f"{self.base_url}/rest/api/1.0{pr_url_stem}", headers=self.auth_header
+        if pr_url_stem in self.merged_prs:
+            return True
+        if pr_url_stem in self.open_prs:
+            return False
+
+        result, response_json, _ = cached_get_url(
+            f"{self.api_root}{pr_url_stem}", headers=self.headers
         )
 
         if not result:
             return False
 
-        response = json.loads(response_json)
+        response = json_loads(response_json)
         pr_state = response.get("state", "")
         return pr_state == "MERGED"
 
-    def merge_pr(self, projectkey, repositoryslug, pullrequestid, version):
+    def prefetch_merged(self, pr_url_stems):
         """
-        Merge the specified pr.
+        Bulk version of is_pr_merged: for each repo with more than one of
+        pr_url_stems, read the repo's open prs, then (if more than one is left)
+        its most recently merged prs, instead of fetching each pr. Those found
+        are recorded in open_prs or merged_prs; is_pr_merged falls back to
+        fetching the rest (eg declined, or merged too long ago to be in that
+        first page).
+        """
+        repos = {}
+        for pr_url_stem in set(pr_url_stems):
+            repo_stem, _, pr_id = pr_url_stem.rpartition("/pull-requests/")
+            repos.setdefault(repo_stem, set()).add(pr_id)
+
+        for repo_stem, pr_ids in repos.items():
+            # merge-after targets are usually still open, so check those first;
+            # that's normally the only request needed for the repo
+            for state, found in (("OPEN", self.open_prs), ("MERGED", self.merged_prs)):
+                # a single lookup is cheaper as a plain GET of that pr
+                if len(pr_ids) < 2:
+                    break
+
+                prs = iter_paged_api(
+                    f"{self.api_root}{repo_stem}/pull-requests",
+                    headers=self.headers,
+                    params={"state": state, "limit": PAGE_LIMIT},
+                )
+                # newest first; only read the first page, a long history isn't
+                # worth paging through
+                for pr_data in itertools.islice(prs, PAGE_LIMIT):
+                    pr_id = str(pr_data["id"])
+                    if pr_id in pr_ids:
+                        found.add(f"{repo_stem}/pull-requests/{pr_id}")
+                        pr_ids.remove(pr_id)
+                        if not pr_ids:
+                            break
+
+    def merge_pr(self, pr_api_url, version):
+        """
+        Merge the specified pr (pr_api_url from pr_api_url()).
 
         Api is
         projects/{projectkey}/repos/{repositoryslug}/pull-requests/{pullrequestid}/merge?version
 
-        Returns True if sucessful False otherwise
+        The version from the dashboard pr data is all the merge needs, so there's
+        no need to GET the merge status first; if the pr can't be merged the
+        server refuses the POST with the reason (eg vetoes, conflicts).
+
+        Returns tuple of (<bool success>, <failure reason>)
         """
+        pr_merge_url = f"{pr_api_url}/merge"
+        # a refused merge (eg 409, not mergeable yet) is routine, and reported
+        # as the failure reason; don't log it again as an http error
+        result, response_json, _ = http_operation(
+            pr_merge_url,
+            "POST",
+            headers=self.headers,
+            params={"version": version},
+            log_errors=False,
+        )
 
-        # check if the PR is ready to merge
-        pr_merge_url = f"{self.base_url}/rest/api/1.0/projects/{projectkey}/repos/{repositoryslug}/pull-requests/{pullrequestid}/merge"
-        result, response_json, _ = get_url(pr_merge_url, headers=self.auth_header)
+        if result:
+            return (True, "")
+        if response_json:
+            return (False, response_json.decode(errors="replace"))
+        return (False, f"error merging {pr_merge_url}")
 
-        if not result:
-            return (False, f"error fetching {pr_merge_url}")
+    def just_merge(self, pr_data, pr_api_url, argument):
+        """Command "merge": issue a non conditional merge"""
+        del argument
+        return self.merge_pr(pr_api_url, pr_data["version"])
 
-        response = json.loads(response_json)
-        canmerge = response.get("canMerge")
-        if not canmerge:
-            return (False, str(response_json))
+    @staticmethod
+    def merge_after_pr_stem(other_pr_url):
+        """
+        Return the pr url stem ("/projects/<project name>/repos/<repo
+        slug>/pull-requests/<pr id>") for a merge-after url, or None if it's not
+        a valid pr url
+        """
+        other_pr_url_stem = urllib.parse.urlsplit(other_pr_url)[2]
 
-        # now try to merge
-        result, _, _ = post_url(
-            pr_merge_url, headers=self.auth_header, params={"version": version}
+        # basic sanity check URL is valid
+        # strip off anything post PR-ID (such as /overview /diff)
+        match = re.match(
+            "(/(?:projects|users)/.*/repos/.*/pull-requests/[0-9]*)[/.*]?",
+            other_pr_url_stem,
         )
+        return match[1] if match else None
+
+    def merge_after(self, pr_data, pr_api_url, other_pr_url):
+        """Command "merge-after <url>": issue a merge if the url is merged"""
+        other_pr_url_stem = self.merge_after_pr_stem(other_pr_url)
+        if not other_pr_url_stem:
+            return (False, f"invalid pr_url {other_pr_url}")
 
-        return (result, "")
+        if self.is_pr_merged(other_pr_url_stem):
+            return self.just_merge(pr_data, pr_api_url, None)
 
-    def process_pr(self, pr_data, merge_trigger, current_user_only_comments):
+        return (False, f"{other_pr_url} not merged yet!")
+
+    # dictionary of command name: method to run on match
+    COMMANDS = {
+        "merge": just_merge,
+        "merge-after": merge_after,
+    }
+
+    @staticmethod
+    def find_command(merge_trigger, list_to_check):
+        """
+        Return the first command found in list_to_check, as a tuple of
+        (<command name>, <argument>), or None if there isn't one.
+
+        Commands have to be on their own line, but surrounding whitespace (eg
+        indentation) and extra spaces between words are ok.
+        Texts that don't mention the trigger at all (most of them), and lines
+        that don't start with it, are skipped with cheap string checks before
+        doing any regex work.
+        """
+        regex = compile_command_regex(merge_trigger)
+        for text in list_to_check:
+            if merge_trigger not in text:
+                continue
+            for line in text.splitlines():
+                line = line.strip()
+                if not line.startswith(merge_trigger):
+                    continue
+                match = regex.fullmatch(line)
+                if match:
+                    command, *argument = match["command"].split(None, 1)
+                    return (command, argument[0] if argument else "")
+        return None
+
+    def pr_api_url_for(self, pr_data):
+        """Return the pr_api_url() for pr json data from the dashboard api"""
+        repository = pr_data["toRef"]["repository"]
+        return self.pr_api_url(
+            repository["project"]["key"], repository["slug"], pr_data["id"]
+        )
+
+    def find_pr_command(self, pr_data, merge_trigger, current_user_only_comments):
         """
-        Process a single pr from the pr json data returned from the dashboard api
+        Look for a command in a single pr from the pr json data returned from
+        the dashboard api, without running it.
 
         Set current_user_only_comments to only trigger on comments by the
         current user (eg same as pr author).
 
-        Returns:
-        - None if merge_trigger wasn't detected
-        - tuple(
-            <pr url string>,
-            tuple(
-                <bool success or failure>, <string of failure reason>
-            ),
-        )
+        Returns None if merge_trigger wasn't detected, otherwise tuple of
+        (<command name>, <argument>)
         """
-        pr_url = pr_data["links"]["self"][0]["href"]
         # print(json.dumps(pr_data))
-        repositoryslug = pr_data["toRef"]["repository"]["slug"]
-        projectkey = pr_data["toRef"]["repository"]["project"]["key"]
-        pullrequestid = pr_data["id"]
 
-        if current_user_only_comments:
-            username = pr_data["author"]["user"]["name"]
-        else:
-            username = None
-
-        def get_comments():
-            return self.get_all_comments(
-                projectkey, repositoryslug, pullrequestid, username
-            )
+        # check PR description then comments. order is important; we don't want to
+        # do the relatively expensive fetch of comments for a PR if the description
+        # has a match
+        command = self.find_command(merge_trigger, [pr_data.get("description", "")])
 
-        def just_merge(match):
-            """Issue a non conditional merge"""
-            del match
-            merge_ok = self.merge_pr(
-                projectkey, repositoryslug, pullrequestid, pr_data["version"],
-            )
-            return (pr_url, merge_ok)
-
-        def merge_after(match):
-            """Issue a merge if the matched url is merged"""
-            other_pr_url = match[1]
-            other_pr_url_stem = urllib.parse.urlsplit(other_pr_url)[2]
-
-            # basic sanity check URL is valid
-            # strip off anything post PR-ID (such as /overview /diff)
-            match = re.match(
-                "(/(?:projects|users)/.*/repos/.*/pull-requests/[0-9]*)[/.*]?",
-                other_pr_url_stem,
-            )
-            if not match:
-                return (pr_url, (False, f"invalid pr_url {other_pr_url}"))
+        # the dashboard reports the comment count; don't bother fetching the
+        # activities if the server says there aren't any comments
+        if not command and pr_data.get("properties", {}).get("commentCount") != 0:
+            if current_user_only_comments:
+                username = pr_data["author"]["user"]["name"]
+            else:
+                username = None
 
-            if self.is_pr_merged(match[1]):
-                return just_merge(match)
+            command = self.find_comment_command(pr_data, merge_trigger, username)
 
-            return (pr_url, (False, f"{other_pr_url} not merged yet!"))
+        return command
 
-        # dictionary of regex-pattern: command to run on match
-        commands = {
-            # command: merge
-            f"^{merge_trigger} merge$": just_merge,
-            # command: merge-after <url>
-            f"^{merge_trigger} merge-after (.*)$": merge_after,
+    def find_comment_command(self, pr_data, merge_trigger, username_filter):
+        """
+        find_command on a pr's comments. Most prs don't change between polls,
+        so if the pr's updatedDate and comment count are the same as the last
+        run the previous result is reused, skipping the activities fetch
+        entirely. Results older than COMMENT_CACHE_MAX_AGE are scanned again,
+        to pick up edited comments.
+        """
+        pr_api_url = self.pr_api_url_for(pr_data)
+        cache_key = [
+            pr_data.get("updatedDate"),
+            pr_data.get("properties", {}).get("commentCount"),
+            merge_trigger,
+            username_filter,
+        ]
+
+        cached = self.comment_cache.get(pr_api_url)
+        if (
+            cached
+            and cache_key[0] is not None
+            and cached["key"] == cache_key
+            and time.time() - cached.get("time", 0) < COMMENT_CACHE_MAX_AGE
+        ):
+            command = cached["command"]
+            scan_time = cached["time"]
+        else:
+            comments = self.get_all_comments(pr_api_url, username_filter)
+            command = self.find_command(merge_trigger, comments)
+            scan_time = time.time()
+
+        self.new_comment_cache[pr_api_url] = {
+            "key": cache_key,
+            "command": command,
+            "time": scan_time,
         }
+        return tuple(command) if command else None
 
-        def process_commands(list_to_check):
-            """Check for match and run command on list_to_check"""
-            for pattern, command in commands.items():
-                regex = re.compile(pattern, re.MULTILINE)
-                match = list(filter(None, map(regex.search, list_to_check)))
-                if match:
-                    return command(match[0])
-            return None
+    def run_pr_command(self, pr_data, command):
+        """
+        Run a command returned from find_pr_command on the pr.
 
-        # check PR description then comments. order is important; we don't want to
-        # do the relatively expensive fetch of comments for a PR if the description
-        # has a match
-        return process_commands([pr_data.get("description", "")]) or process_commands(
-            get_comments()
+        Returns:
+        tuple(
+            <pr url string>,
+            tuple(
+                <bool success or failure>, <string of failure reason>
+            ),
+        )
+        """
+        pr_url = pr_data["links"]["self"][0]["href"]
+        command, argument = command
+        result = self.COMMANDS[command](
+            self, pr_data, self.pr_api_url_for(pr_data), argument
         )
+        return (pr_url, result)
+
+
+def run_pr_commands(bitbucket, pr_list, commands, log_success_prefix):
+    """
+    Run the commands found for pr_list (commands[i] is the find_pr_command
+    result for pr_list[i]), looking up the merge-after prs in bulk first.
+    Results are logged as each pr finishes, so one slow pr doesn't hold up
+    reporting the rest
+    """
+    pr_commands = [(pr, command) for pr, command in zip(pr_list, commands) if command]
+    merge_after_prs = [
+        bitbucket.merge_after_pr_stem(command[1])
+        for _, command in pr_commands
+        if command[0] == "merge-after"
+    ]
+    bitbucket.prefetch_merged(filter(None, merge_after_prs))
+    with Halo(text="Running PR commands", spinner="dots", stream=sys.stderr) as spinner:
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_THREADS, len(pr_commands)) or 1
+        ) as executor:
+            futures = [
+                executor.submit(bitbucket.run_pr_command, pr, command)
+                for pr, command in pr_commands
+            ]
+
+            # output results from run_pr_command.
+            # the return value is a tuple:
+            # ('PR URL', (True/False <success code>, string <extra info>))
+            for future in as_completed(futures):
+                merged = future.result()
+                if merged[1][0]:
+                    logging.info(f"{log_success_prefix} Merged {merged[0]}")
+                else:
+                    logging.info(f"Failed to merge {merged[0]} : {merged[1][1]}")
+        spinner.succeed()
 
 
 def main():
@@ -365,10 +852,8 @@ def main():
     bitbucket_url = os.environ.get("POLLY_MERGE_BITBUCKET_URL")
     assert bitbucket_url, "Please set POLLY_MERGE_BITBUCKET_URL!"
 
-    current_user_only_comments = bool(
-        distutils_util.strtobool(
-            os.environ.get("POLLY_MERGE_ANY_USER_COMMENT", "False")
-        )
+    current_user_only_comments = strtobool(
+        os.environ.get("POLLY_MERGE_ANY_USER_COMMENT", "False")
     )
 
     log_file = os.environ.get("POLLY_MERGE_LOG_FILE")
@@ -395,6 +880,7 @@ def main():
     logging.basicConfig(**logging_setup)
 
     bitbucket = BitbucketApi(base_url=bitbucket_url, auth_header=auth_header)
+    bitbucket.load_comment_cache()
 
     # 1. get all open pull requests
     with Halo(text="Loading open PRs", spinner="dots", stream=sys.stderr) as spinner:
@@ -406,37 +892,35 @@ def main():
     # with open("prs2.json", "r") as pr_json:
     #     pr_list = json.load(pr_json)
 
-    # 2. for each open pull request, look for the key comment and attempt merge
+    # 2. for each open pull request, look for the key comment
 
-    # use multiprocessing.dummy.Pool to use threads instead of multiple
-    # processes; this is simpler than using normal multiprocessing, because we
-    # want to pass through the config options (from env variables), and
-    # multiprocessing needs a hashable callable to run Pool.map.
+    # use a thread pool instead of multiple processes; this is simpler than
+    # using multiprocessing, because we want to pass through the config options
+    # (from env variables), and multiprocessing needs a hashable callable.
     #
     # using python threads is suitable here because the http calls are the
     # blocking ones, so they do a decent job yielding. using a pool speeds this
     # up dramatically if there's lots of open pr's, because we spend most of the
     # time waiting on the server
-    def process_pr_wrapper(pr_data):
-        return bitbucket.process_pr(pr_data, merge_trigger, current_user_only_comments)
+    def find_pr_command_wrapper(pr_data):
+        return bitbucket.find_pr_command(
+            pr_data, merge_trigger, current_user_only_comments
+        )
 
-    # issue all the pr data requests simultaneously (up to 50). most won't
-    # require paging (>25 "activities") so this should be pretty good
+    # issue the pr data requests simultaneously (up to MAX_THREADS). most won't
+    # require paging (>1000 "activities") so this should be pretty good.
     with Halo(
         text="Checking PRs for merge comment", spinner="dots", stream=sys.stderr
     ) as spinner:
-        with Pool(min(50, len(pr_list))) as pool:
-            results = pool.map(process_pr_wrapper, pr_list)
+        with ThreadPoolExecutor(
+            max_workers=min(MAX_THREADS, len(pr_list)) or 1
+        ) as executor:
+            commands = list(executor.map(find_pr_command_wrapper, pr_list))
         spinner.succeed()
+    bitbucket.save_comment_cache()
 
-    # output results from process_pr_wrapper.
-    # the return value is a tuple:
-    # ('PR URL', (True/False <success code>, string <extra info>))
-    for merged in filter(None, results):
-        if merged[1][0]:
-            logging.info(f"{log_success_prefix} Merged {merged[0]}")
-        else:
-            logging.info(f"Failed to merge {merged[0]} : {merged[1][1]}")
+    # 3. run the commands that were found
+    run_pr_commands(bitbucket, pr_list, commands, log_success_prefix)
 
 
 if __name__ == "__main__":